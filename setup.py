@@ -0,0 +1,24 @@
+""" Build the DNS message module as a Cython extension and the C responder core. """
+import platform
+import sys
+
+from setuptools import Extension, setup
+
+ext_modules = []
+
+# Interpreters other than CPython (e.g. PyPy) keep using the pure Python module
+if platform.python_implementation() == 'CPython':
+    from Cython.Build import cythonize
+    # Types come from dns_message.pxd; the annotations also accept bytes for bytearray
+    ext_modules = cythonize(['src/dns_message.py'], language_level=3,
+                            compiler_directives={'annotation_typing': False})
+
+    # recvmmsg and sendmmsg are Linux only
+    if sys.platform.startswith('linux'):
+        ext_modules.append(Extension('dns_core', ['src/dns_core.c']))
+
+setup(
+    name='minimal_dns_spoofer',
+    package_dir={'': 'src'},
+    ext_modules=ext_modules,
+)
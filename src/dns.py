@@ -1,10 +1,34 @@
 """ Listen on the DNS port for any A record request and return a fixed hard coded address. """
-from dns_message import Message
 import argparse
+import importlib.util
+import os
+import socket
+import sys
 import daemon
 from daemon import pidfile
 
-def main(socket_address: str = '127.0.0.1'):
+# Setting DNS_SPOOFER_PURE_PYTHON=1 ignores the compiled extensions and runs the pure Python modules
+PURE_PYTHON = os.environ.get('DNS_SPOOFER_PURE_PYTHON') == '1'
+
+# Load dns_message.py even when a compiled dns_message extension sits next to it.
+# A Nuitka binary has no source next to it, so it keeps whatever it was built with.
+_SOURCE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'dns_message.py')
+if PURE_PYTHON and os.path.exists(_SOURCE):
+    _spec = importlib.util.spec_from_file_location('dns_message', _SOURCE)
+    sys.modules['dns_message'] = importlib.util.module_from_spec(_spec)
+    _spec.loader.exec_module(sys.modules['dns_message'])
+
+from dns_message import Message, SPOOFED_ADDRESS
+
+# Optional C responder core, built with setup.py on Linux
+dns_core = None
+if not PURE_PYTHON:
+    try:
+        import dns_core
+    except ImportError:
+        pass
+
+def main(socket_address: str = '127.0.0.1', reuse_port: bool = False):
     """
     Listen for any A record request and return a hard coded address.
 
@@ -12,25 +36,36 @@ def main(socket_address: str = '127.0.0.1'):
     ----------
     socket_address : str
         string of ipv4 address, set to 127.0.0.1 if none entered
+    reuse_port : bool
+        share the DNS port with other workers, set to False if none entered
     """
     # Open a socket
     response = Message(socket_address, 53)
     response.start_socket()
-    response.bind()
+    response.bind(reuse_port)
 
-    # Continually listen for any A record requests, send back fixed response
+    # Hand the socket over to the C core when it has been built, it never returns
+    if dns_core is not None:
+        address = int.from_bytes(socket.inet_aton(SPOOFED_ADDRESS), 'big')
+        dns_core.serve_forever(response.socket.fileno(), address)
+
+    # Look up the bound methods once rather than on every iteration
+    receive_batch = response.receive_batch
+    send_responses = response.send_responses
+
+    # Continually listen for batches of A record requests, send back fixed responses
     while True:
         try:
-            query, address = response.receive()
+            requests = receive_batch()
 
-        except response.socket.timeout:
+        except socket.timeout:
             continue
 
-        finally:
-            response.send_response(query, address)
+        else:
+            send_responses(requests)
 
 
-def launch_daemon(socket_address: str = '127.0.0.1'):
+def launch_daemon(socket_address: str = '127.0.0.1', workers: int = 1):
     """
     Launch a daemon running the process in main().
 
@@ -38,17 +73,28 @@ def launch_daemon(socket_address: str = '127.0.0.1'):
     ----------
     socket_address : str
         string of ipv4 address, set to 127.0.0.1 if none entered
+    workers : int
+        number of processes running main(), set to 1 if none entered
     """
     with daemon.DaemonContext():
         print("Launched daemon")
-        main(socket_address)
+
+        # Fork the extra workers, the kernel spreads requests across their sockets
+        for _ in range(workers - 1):
+            if os.fork() == 0:
+                break
+
+        # Only share the port between our own workers, a second daemon still fails to bind
+        main(socket_address, workers > 1)
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Minimal DNS Spoofer.')
     parser.add_argument('-address', type=str,
                         default="127.0.0.1", help='address for the DNS socket')
+    parser.add_argument('-workers', type=int,
+                        default=1, help='number of worker processes sharing the DNS port')
 
     args = parser.parse_args()
 
-    launch_daemon(args.address)
+    launch_daemon(args.address, args.workers)
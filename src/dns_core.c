@@ -0,0 +1,204 @@
+/*
+ * Serve spoofed A record responses entirely in C.
+ *
+ * Requests are received in batches with recvmmsg, turned into responses in
+ * place in their receive buffers and sent back in batches with sendmmsg.
+ * The responses are identical to dns_message.build_response in Python.
+ *
+ * Source for DNS packet construction information: https://datatracker.ietf.org/doc/html/rfc1035#page-26
+ */
+#define _GNU_SOURCE
+#define PY_SSIZE_T_CLEAN
+#include <Python.h>
+
+#include <errno.h>
+#include <netinet/in.h>
+#include <string.h>
+#include <sys/socket.h>
+
+#define BATCH_SIZE 32
+#define BUFFER_SIZE 4096
+#define HEADER_SIZE 12
+#define ANSWER_SIZE 16
+
+/* Pointer to the qname at offset 12, A record, internet class, TTL of 0, 4 octets of rdata */
+static const unsigned char answer_prefix[ANSWER_SIZE - 4] = {
+    0xC0, 0x0C, 0x00, 0x01, 0x00, 0x01, 0x00, 0x00, 0x00, 0x00, 0x00, 0x04};
+
+/* One answer, no authority or additional records */
+static const unsigned char response_counts[6] = {0x00, 0x01, 0x00, 0x00, 0x00, 0x00};
+
+/*
+ * Rewrite a request in its buffer into the response for it.
+ *
+ * Returns the length of the response, or 0 if the request is malformed and
+ * should be dropped. The buffer must have room for ANSWER_SIZE bytes past
+ * the received data.
+ */
+static size_t build_response(unsigned char *buf, size_t len, const unsigned char *address)
+{
+    unsigned char *nul;
+    size_t question_stop;
+
+    if (len <= HEADER_SIZE) {
+        return 0;
+    }
+
+    /* Find the null byte terminating the qname, then skip over it, qtype and qclass */
+    nul = memchr(buf + HEADER_SIZE, 0, len - HEADER_SIZE);
+    if (nul == NULL || (size_t)(nul - buf) + 5 > len) {
+        return 0;
+    }
+    question_stop = (size_t)(nul - buf) + 5;
+
+    /* Only echo the question back for A record internet class requests */
+    if (buf[question_stop - 1] != 1 || buf[question_stop - 3] != 1) {
+        question_stop = HEADER_SIZE;
+    }
+
+    /* Set QR and RA, keep opcode, TC, RD and Z, and flag non-standard queries as not implemented */
+    buf[3] = 0x80 | (buf[3] & 0x70) | ((buf[2] & 0x78) ? 4 : 0);
+    buf[2] = 0x80 | (buf[2] & 0x7B);
+    memcpy(buf + 6, response_counts, sizeof(response_counts));
+
+    memcpy(buf + question_stop, answer_prefix, sizeof(answer_prefix));
+    memcpy(buf + question_stop + sizeof(answer_prefix), address, 4);
+
+    return question_stop + ANSWER_SIZE;
+}
+
+static PyObject *serve_forever(PyObject *self, PyObject *args)
+{
+    int fd;
+    unsigned int ip;
+    unsigned char address[4];
+
+    unsigned char (*bufs)[BUFFER_SIZE + ANSWER_SIZE];
+    struct sockaddr_in addrs[BATCH_SIZE];
+    struct iovec recv_iovs[BATCH_SIZE];
+    struct iovec send_iovs[BATCH_SIZE];
+    struct mmsghdr recv_msgs[BATCH_SIZE];
+    struct mmsghdr send_msgs[BATCH_SIZE];
+
+    if (!PyArg_ParseTuple(args, "iI:serve_forever", &fd, &ip)) {
+        return NULL;
+    }
+
+    address[0] = (ip >> 24) & 0xFF;
+    address[1] = (ip >> 16) & 0xFF;
+    address[2] = (ip >> 8) & 0xFF;
+    address[3] = ip & 0xFF;
+
+    /* Leave room after each received request for the answer appended to it */
+    bufs = PyMem_RawMalloc(BATCH_SIZE * sizeof(*bufs));
+    if (bufs == NULL) {
+        return PyErr_NoMemory();
+    }
+
+    memset(recv_msgs, 0, sizeof(recv_msgs));
+    memset(send_msgs, 0, sizeof(send_msgs));
+
+    for (int i = 0; i < BATCH_SIZE; i++) {
+        recv_iovs[i].iov_base = bufs[i];
+        recv_iovs[i].iov_len = BUFFER_SIZE;
+        recv_msgs[i].msg_hdr.msg_iov = &recv_iovs[i];
+        recv_msgs[i].msg_hdr.msg_iovlen = 1;
+        recv_msgs[i].msg_hdr.msg_name = &addrs[i];
+    }
+
+    for (;;) {
+        int received, sent, count;
+
+        /* The kernel overwrites the address lengths on every call */
+        for (int i = 0; i < BATCH_SIZE; i++) {
+            recv_msgs[i].msg_hdr.msg_namelen = sizeof(struct sockaddr_in);
+        }
+
+        Py_BEGIN_ALLOW_THREADS
+        received = recvmmsg(fd, recv_msgs, BATCH_SIZE, MSG_WAITFORONE, NULL);
+        Py_END_ALLOW_THREADS
+
+        if (received < 0) {
+            if (errno == EINTR && PyErr_CheckSignals() == 0) {
+                continue;
+            }
+            goto error;
+        }
+
+        /* Build the responses in place, reusing each request's buffer and address */
+        count = 0;
+        for (int i = 0; i < received; i++) {
+            size_t len = build_response(bufs[i], recv_msgs[i].msg_len, address);
+            if (len == 0) {
+                continue;
+            }
+
+            send_iovs[count].iov_base = bufs[i];
+            send_iovs[count].iov_len = len;
+            send_msgs[count].msg_hdr.msg_iov = &send_iovs[count];
+            send_msgs[count].msg_hdr.msg_iovlen = 1;
+            send_msgs[count].msg_hdr.msg_name = &addrs[i];
+            send_msgs[count].msg_hdr.msg_namelen = recv_msgs[i].msg_hdr.msg_namelen;
+            count++;
+        }
+
+        /* sendmmsg may send only part of the batch, keep going until it has all been sent */
+        sent = 0;
+        while (sent < count) {
+            int result;
+
+            Py_BEGIN_ALLOW_THREADS
+            result = sendmmsg(fd, send_msgs + sent, count - sent, 0);
+            Py_END_ALLOW_THREADS
+
+            if (result < 0) {
+                if (errno == EINTR) {
+                    if (PyErr_CheckSignals() == 0) {
+                        continue;
+                    }
+                    goto error;
+                }
+                if (errno == EBADF || errno == ENOTSOCK) {
+                    goto error;
+                }
+
+                /* Only this client's response failed, e.g. it sent from port 0, so skip it */
+                result = 1;
+            }
+            sent += result;
+        }
+    }
+
+error:
+    /* A signal handler may already have raised, otherwise report the failed call */
+    if (!PyErr_Occurred()) {
+        PyErr_SetFromErrno(PyExc_OSError);
+    }
+    PyMem_RawFree(bufs);
+    return NULL;
+}
+
+static PyMethodDef dns_core_methods[] = {
+    {"serve_forever", serve_forever, METH_VARARGS,
+     "serve_forever(fd, address)\n"
+     "--\n\n"
+     "Answer every A record request on a bound UDP socket with a fixed address.\n\n"
+     "Parameters\n"
+     "----------\n"
+     "fd : int\n"
+     "    file descriptor of a bound IPv4 UDP socket\n"
+     "address : int\n"
+     "    IPv4 address returned in every answer, as a 32 bit integer\n"},
+    {NULL, NULL, 0, NULL}};
+
+static struct PyModuleDef dns_core_module = {
+    PyModuleDef_HEAD_INIT,
+    "dns_core",
+    "Serve spoofed A record responses with recvmmsg and sendmmsg, without the interpreter.",
+    -1,
+    dns_core_methods};
+
+PyMODINIT_FUNC PyInit_dns_core(void)
+{
+    return PyModule_Create(&dns_core_module);
+}
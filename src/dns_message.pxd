@@ -0,0 +1,26 @@
+# Cython declarations augmenting dns_message.py, used when building it with setup.py.
+# The module stays importable as plain Python when it has not been compiled.
+
+cimport cython
+
+cdef class Message:
+    cdef public object address
+    cdef public object port
+    cdef public object socket
+    cdef bint _connected
+    cdef object _receiver
+    cdef bytearray _rx_buf
+    cdef object _rx_mv
+
+    cpdef bytes _construct_header(self, int identifier, int qr, int opcode, int aa, int tc, int rd,
+                                  int ra, int z, int rcode, int qdcount, int ancount, int nscount,
+                                  int arcount)
+
+    @cython.locals(i=Py_ssize_t)
+    cpdef Py_ssize_t parse_query_question(self, query) except -1
+
+    cpdef send_response(self, request, address)
+
+
+@cython.locals(question_stop=Py_ssize_t)
+cpdef bytes build_response(request)
@@ -1,10 +1,41 @@
 """ A class for constructing a DNS messages for A record requests. """
 
+import select
 import socket
+import struct
 import sys
+from functools import lru_cache
+
+import mmsg
 
 # Source for DNS packet construction information: https://datatracker.ietf.org/doc/html/rfc1035#page-26
 
+# ID, flags, QDcount, ANcount, NScount, ARcount
+_HDR = struct.Struct('>HHHHHH')
+
+# ID, flag bytes 3 and 4, QDcount of a received request
+_REQUEST_HDR = struct.Struct('>HBBH')
+
+# QType, QClass
+_QTYPE_QCLASS = struct.Struct('>HH')
+
+# Fixed query header: ID 0xAABB, recursion desired, one question
+_STATIC_QUERY_HEADER = b'\xaa\xbb\x01\x00\x00\x01\x00\x00\x00\x00\x00\x00'
+
+# Longest legal question: a 255 byte qname followed by qtype and qclass
+_MAX_QUESTION = 255 + 4
+
+# Fixed response counts: one answer, no authority or additional records
+_STATIC_RESPONSE_COUNTS = b'\x00\x01\x00\x00\x00\x00'
+
+# Address returned for every A record request
+SPOOFED_ADDRESS = '6.6.6.6'
+
+# Fixed answer: pointer to the qname at offset 12, A record, internet class,
+# TTL of 0, 4 octets of rdata containing the spoofed address
+_STATIC_ANSWER = b'\xc0\x0c\x00\x01\x00\x01\x00\x00\x00\x00\x00\x04' + \
+    socket.inet_aton(SPOOFED_ADDRESS)
+
 
 class Message():
     """
@@ -27,7 +58,7 @@ class Message():
     a_record_response_header(request, implemented)
         Generates a DNS response header based on a provided A record request.
 
-    _construct_header(self, response_flag, identifier, qr, opcode, 
+    _construct_header(self, identifier, qr, opcode, 
         aa, tc, rd, ra, z, rcode, qdcount, ancount, nscount, arcount)
         Returns a header given all the parameters required.
 
@@ -46,17 +77,26 @@ class Message():
     start_socket()
         Starts a socket for IPv4.
 
-    bind()
+    bind(reuse_port)
         Binds a socket to a specific address and port.
 
+    connect()
+        Connects a socket to a specific address and port.
+
     send_query(url)
         Given a URL construct a A record request and send it.
 
     receive()
         Receive data from a socket.
 
+    receive_batch(max_batch)
+        Wait for data on a socket, then receive whatever else is already queued.
+
     send_response(request, address)
         Construct a DNS response and send it to the same address the request was received from.
+
+    send_responses(requests)
+        Construct DNS responses for a batch of requests and send them together.
     """
 
     def __init__(self, address: str, port: int):
@@ -71,6 +111,16 @@ class Message():
         self.address = address
         self.port = port
 
+        # Whether the socket has been connected to the address, see connect()
+        self._connected = False
+
+        # recvmmsg wrapper, created on the first call to receive_batch
+        self._receiver = None
+
+        # Buffer reused by every recvfrom_into call, only the received bytes are copied out
+        self._rx_buf = bytearray(4096)
+        self._rx_mv = memoryview(self._rx_buf)
+
     """
     The DNS query header follows the format:
         ID: 16 bit request identifier
@@ -118,7 +168,7 @@ class Message():
         ARcount: 16 bit number of resource records in the additional records section
     """
 
-    def a_record_query_header(self) -> bytearray:
+    def a_record_query_header(self) -> bytes:
         """
         Generate a header for an A record DNS query.
 
@@ -126,32 +176,16 @@ class Message():
 
         Returns
         -------
-        header : bytearray
-            bytearray of the constructed header
+        header : bytes
+            bytes of the constructed header
         """
-        identifier = 0xAABB
-        qr = 0
-        opcode = 0
-        aa = 0
-        tc = 0
-        rd = 1
-        ra = 0
-        z = 0
-        rcode = 0
-        qdcount = 1
-        ancount = 0
-        nscount = 0
-        arcount = 0
-
-        header = self._construct_header(False, identifier, qr, opcode, aa, tc, rd, ra, z, rcode,
-                                        qdcount, ancount, nscount, arcount)
-        return header
+        return _STATIC_QUERY_HEADER
 
     """
     The DNS response header follows the same format as the query header.
     """
 
-    def a_record_response_header(self, request: bytearray, implemented: bool) -> bytearray:
+    def a_record_response_header(self, request: bytearray, implemented: bool) -> bytes:
         """
         Generate a header for a DNS response.
 
@@ -164,19 +198,17 @@ class Message():
 
         Returns
         -------
-        header : bytearray
-            bytearray of the constructed header
+        header : bytes
+            bytes of the constructed header
         """
         # Deconstruct the query header
-        identifier = request[0:2]
-        opcode = (request[2] & 0x78) >> 3
-        tc = (request[2] & 0x02) >> 1
-        rd = (request[2] & 0x01)
-
-        z = (request[3] & 70) >> 4
-        rcode = (request[3] & 0x0F)
+        identifier, byte_3, byte_4, qdcount = _REQUEST_HDR.unpack_from(request)
+        opcode = (byte_3 >> 3) & 0x0F
+        tc = (byte_3 >> 1) & 0x01
+        rd = byte_3 & 0x01
 
-        qdcount = request[4:6]
+        z = (byte_4 >> 4) & 0x07
+        rcode = byte_4 & 0x0F
 
         # Prepare other parameters for the response header
         qr = 1  # Set to high because it is a response
@@ -194,21 +226,19 @@ class Message():
             rcode = 0
 
         # Contruct a header
-        header = self._construct_header(True, identifier, qr, opcode, aa, tc,
+        header = self._construct_header(identifier, qr, opcode, aa, tc,
                                         rd, ra, z, rcode, qdcount, ancount, nscount, arcount)
 
         return header
 
-    def _construct_header(self, response_flag: bool, identifier, qr, opcode, aa, tc, rd, ra,
-                          z, rcode, qdcount, ancount, nscount, arcount) -> bytearray:
+    def _construct_header(self, identifier, qr, opcode, aa, tc, rd, ra,
+                          z, rcode, qdcount, ancount, nscount, arcount) -> bytes:
         """
         Construct a header given all of the required components.
 
         Parameters
         ----------
-        response_flag : bool
-            flag indicating whether or not the header is for a response
-        identifier : int or bytearray
+        identifier : int
             DNS header identifier
         qr : int
             query or response flag
@@ -226,7 +256,7 @@ class Message():
             reserved for future use and must be zero always
         rcode : int
             response code
-        qdcount : int or bytearray
+        qdcount : int
             number of entries in question section
         ancount : int
             number of entries in resource records of answer section
@@ -237,40 +267,15 @@ class Message():
 
         Returns
         -------
-        header : bytearray
+        header : bytes
             final constructed header
         """
 
-        # Construct bytes from all parameters that cannot be a bytearray.
-        byte_3 = bytearray([(qr << 7) | (opcode << 3) |
-                            (aa << 2) | (tc << 1) | rd])
+        # Pack all of the flags into a single 16 bit field
+        flags = (qr << 15) | (opcode << 11) | (aa << 10) | (tc << 9) | (rd << 8) | \
+            (ra << 7) | (z << 4) | rcode
 
-        byte_4 = bytearray([ra << 7 | z << 4 | rcode])
-
-        an_upper, an_lower = divmod(ancount, 0x100)
-        byte_7_8 = bytearray([an_upper, an_lower])
-
-        ns_upper, ns_lower = divmod(nscount, 0x100)
-        byte_9_10 = bytearray([ns_upper, ns_lower])
-
-        ar_upper, ar_lower = divmod(arcount, 0x100)
-        byte_11_12 = bytearray([ar_upper, ar_lower])
-
-        # If the header is for a request convert to bytearray
-        if response_flag is False:
-            id_upper, id_lower = divmod(identifier, 0x100)
-            byte_1_2 = bytearray([id_upper, id_lower])
-
-            qd_upper, qd_lower = divmod(qdcount, 0x100)
-            byte_5_6 = bytearray([qd_upper, qd_lower])
-
-        else:
-            byte_1_2 = identifier
-            byte_5_6 = qdcount
-
-        # Concatenate all the pieces of the header together
-        header = byte_1_2 + byte_3 + byte_4 + \
-            byte_5_6 + byte_7_8 + byte_9_10 + byte_11_12
+        header = _HDR.pack(identifier, flags, qdcount, ancount, nscount, arcount)
 
         return header
 
@@ -288,7 +293,7 @@ class Message():
             1 - Internet Class
     """
 
-    def a_record_query_question(self, url: str):
+    def a_record_query_question(self, url: str) -> bytes:
         """
         Construct an A record query question section.
 
@@ -302,7 +307,7 @@ class Message():
         question = self._construct_question(url, qtype, qclass)
         return question
 
-    def _construct_question(self, url: str, qtype: int, qclass: int) -> bytearray:
+    def _construct_question(self, url: str, qtype: int, qclass: int) -> bytes:
         """
         Generate the question section for a A record DNS request.
 
@@ -317,31 +322,15 @@ class Message():
 
         Returns
         -------
-        question : bytearray
+        question : bytes
             final constructed question section
         """
-        # Convert a url into distinct labels
-        url = url.split('.')
-
-        qname = bytearray(0)
-
-        for label in url:
-            length = bytearray([len(label)])
-            label_string = bytearray(label.encode())
-            qname = qname + length + label_string
-
-        null_byte = bytearray([0])
-
-        # qtype byte construction
-        qtype_upper, qtype_lower = divmod(qtype, 0x100)
-        qtype_bytes = bytearray([qtype_upper, qtype_lower])
-
-        # qclass byte construction
-        qclass_upper, qclass_lower = divmod(qclass, 0x100)
-        qclass_bytes = bytearray([qclass_upper, qclass_lower])
+        # Convert a url into distinct labels, each preceded by its length
+        labels = [label.encode() for label in url.split('.')]
+        qname = b''.join([bytes((len(label),)) + label for label in labels])
 
         # Concatenate the final question section
-        question = qname + null_byte + qtype_bytes + qclass_bytes
+        question = qname + b'\x00' + _QTYPE_QCLASS.pack(qtype, qclass)
 
         return question
 
@@ -362,19 +351,10 @@ class Message():
             returns 0 if the request is not an A record internet class request
         """
 
-        search = True
-        i = 12
-
-        # Iterate through the request until the null byte is found,
-        while search is True:
-            length = int(query[i])
-            i = i + length + 1
-            if length is 0:
-                search = False
-                i = i + 4
-        stop = i + 12
+        # Find the null byte terminating the qname, then skip over it, qtype and qclass
+        i = query.index(0, 12) + 5
 
-        if int(query[i-1]) is 1 and int(query[i-3]) is 1:
+        if query[i-1] == 1 and query[i-3] == 1:
             return i
         else:
             return 0
@@ -399,24 +379,16 @@ class Message():
         RData: 4 octect internet address for A record requests
     """
 
-    def a_record_response_answer(self) -> bytearray:
+    def a_record_response_answer(self) -> bytes:
         """
         Construct an A record response to the request with constant rdata.
 
         Returns
         -------
-        answer : bytearray
+        answer : bytes
             constructed answer section bytes for DNS response
         """
-        name = bytearray([(0b11 << 6), 12])
-        answer_type = bytearray([0, 1])
-        answer_class = bytearray([0, 1])
-        ttl = bytearray([0, 0, 0, 0])
-        rdlength = bytearray([0, 4])
-        rdata = bytearray([6, 6, 6, 6])
-
-        answer = name + answer_type + answer_class + ttl + rdlength + rdata
-        return answer
+        return _STATIC_ANSWER
 
     def start_socket(self):
         """
@@ -424,24 +396,48 @@ class Message():
         """
         try:
             self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self._connected = False
         except socket.error as e:
             print("Error creating socket: %s", e, file=sys.stderr)
             sys.exit(-1)
 
-    def bind(self):
+    def bind(self, reuse_port: bool = False):
         """
         Binds a socket to a specific address and port.
+
+        Parameters
+        ----------
+        reuse_port : bool
+            share the port with SO_REUSEPORT where available, so that several
+            worker processes can each bind their own socket to it
         """
         try:
+            if reuse_port and hasattr(socket, 'SO_REUSEPORT'):
+                self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
             self.socket.bind((self.address, self.port))
         except socket.error as e:
             print("Error binding socket: %s", e, file=sys.stderr)
             sys.exit(-1)
 
+    def connect(self):
+        """
+        Connects a socket to a specific address and port.
+
+        The destination is then resolved once here rather than on every send.
+        """
+        try:
+            self.socket.connect((self.address, self.port))
+            self._connected = True
+        except socket.error as e:
+            print("Error connecting socket: %s", e, file=sys.stderr)
+            sys.exit(-1)
+
     def send_query(self, url: str):
         """
         Given a URL construct a A record request and send it.
 
+        The socket is connected with connect() on the first call if it has not been already.
+
         Parameters
         ----------
         url : str
@@ -451,10 +447,12 @@ class Message():
         header = self.a_record_query_header()
         question = self.a_record_query_question(url)
 
-        # Construct the packet and sent it
+        # Construct the packet and sent it to the connected address
         packet = header + question
+        if not self._connected:
+            self.connect()
         try:
-            self.socket.sendto(packet, (self.address, self.port))
+            self.socket.send(packet)
         except socket.error as e:
             print("Error sending packet: %s", e, file=sys.stderr)
             sys.exit(-1)
@@ -465,16 +463,69 @@ class Message():
 
         Returns
         -------
-        data : bytearray
-            bytearray of the data received
+        data : bytes
+            bytes of the data received
         address : int
             address the data was received from
         """
         try:
-            data, address = self.socket.recvfrom(4096)
+            nbytes, address = self.socket.recvfrom_into(self._rx_buf, 4096)
+        except socket.timeout:
+            raise
         except socket.error as e:
             print("Error receiving data: %s", e, file=sys.stderr)
-        return data, address
+            sys.exit(-1)
+        return bytes(self._rx_mv[:nbytes]), address
+
+    def receive_batch(self, max_batch: int = 32) -> list:
+        """
+        Wait for data on a socket, then receive whatever else is already queued.
+
+        The batch is received with a single recvmmsg call where it is available,
+        and falls back to draining the socket with recvfrom_into otherwise.
+        Raises socket.timeout if the socket has a timeout and nothing arrives in time.
+
+        Parameters
+        ----------
+        max_batch : int
+            maximum number of datagrams to return
+
+        Returns
+        -------
+        batch : list
+            list of (data, address) tuples received
+        """
+        if not mmsg.HAVE_RECVMMSG:
+            batch = [self.receive()]
+
+            # Only take datagrams that are already waiting, without switching the socket mode
+            try:
+                while len(batch) < max_batch:
+                    nbytes, address = self.socket.recvfrom_into(self._rx_buf, 4096,
+                                                                socket.MSG_DONTWAIT)
+                    batch.append((bytes(self._rx_mv[:nbytes]), address))
+            except BlockingIOError:
+                pass
+
+            return batch
+
+        # The receiver reuses its buffers, so only rebuild it when a larger batch is needed
+        if self._receiver is None or self._receiver.vlen < max_batch:
+            self._receiver = mmsg.Receiver(self.socket.fileno(), max_batch)
+
+        # A socket with a timeout is non-blocking underneath, so wait on it the way recvfrom does
+        timeout = self.socket.gettimeout()
+        if timeout is not None and not select.select([self.socket], [], [], timeout)[0]:
+            raise socket.timeout("timed out")
+
+        try:
+            return self._receiver.receive()
+        except BlockingIOError:
+            # Another worker sharing the port took the queued datagrams first
+            raise socket.timeout("timed out")
+        except socket.error as e:
+            print("Error receiving data: %s", e, file=sys.stderr)
+            sys.exit(-1)
 
     def send_response(self, request, address):
         """
@@ -487,16 +538,11 @@ class Message():
         address : int
             address the request was received from
         """
-        question_stop = self.parse_query_question(request)
-        
-        if question_stop is 0:
-            header = self.a_record_response_header(request, False)
-        else:
-            header = self.a_record_response_header(request, True)
+        packet = build_response(request)
 
-        answer = self.a_record_response_answer()
-
-        packet = header + request[12: question_stop] + answer
+        # Malformed requests get no response
+        if packet is None:
+            return
 
         try:
             self.socket.sendto(packet, address)
@@ -504,3 +550,111 @@ class Message():
         except socket.error as e:
             print("Error sending packet: %s", e, file=sys.stderr)
             sys.exit(-1)
+
+    def send_responses(self, requests: list):
+        """
+        Construct DNS responses for a batch of requests and send them together.
+
+        The batch is sent with a single sendmmsg call where it is available, and
+        falls back to one sendto per response otherwise.
+
+        Parameters
+        ----------
+        requests : list
+            list of (request, address) tuples received
+        """
+        # Malformed requests are dropped so they cannot affect the rest of the batch
+        packets = []
+        for request, address in requests:
+            packet = build_response(request)
+            if packet is not None:
+                packets.append((packet, address))
+
+        try:
+            if mmsg.HAVE_SENDMMSG:
+                mmsg.sendmmsg_batch(self.socket.fileno(), packets)
+            else:
+                for packet, address in packets:
+                    try:
+                        self.socket.sendto(packet, address)
+                    except socket.error as e:
+                        # Skip a failing client unless the socket itself is broken
+                        if e.errno in mmsg.SOCKET_ERRORS:
+                            raise
+
+        except socket.error as e:
+            print("Error sending packet: %s", e, file=sys.stderr)
+            sys.exit(-1)
+
+
+def _build_template(header: bytes, question: bytes) -> bytes:
+    """
+    Construct everything in a DNS response following the ID.
+
+    Apart from the ID, the response only depends on the flags, the question
+    count and the question, so results are cached by _cached_template.
+
+    Parameters
+    ----------
+    header : bytes
+        bytes 3 to 6 of the request header: both flag bytes and QDcount
+    question : bytes
+        question section to echo back, empty if it is not an A record request
+
+    Returns
+    -------
+    template : bytes
+        constructed DNS response without the leading 2 byte ID
+    """
+    # Set QR and RA, keep opcode, TC, RD and Z, and flag non-standard queries as not implemented
+    byte_3 = header[0]
+    rcode = 4 if byte_3 & 0x78 else 0
+    flags = bytes((0x80 | (byte_3 & 0x7B), 0x80 | (header[1] & 0x70) | rcode))
+
+    return b''.join([flags, header[2:4], _STATIC_RESPONSE_COUNTS, question, _STATIC_ANSWER])
+
+
+# Bounded LRU over _build_template, so a flood of random names cannot grow it without limit.
+# Only questions up to the longest legal qname are cached, which keeps each entry, with
+# its key, value and LRU bookkeeping, under about 1KB and the whole cache under about 4MB.
+_cached_template = lru_cache(maxsize=4096)(_build_template)
+
+
+def build_response(request: bytearray) -> bytes:
+    """
+    Construct the DNS response for a request.
+
+    Only the ID, the echoed flags, the question count and the question depend
+    on the request, everything else in the response is constant. This gives
+    the same result as combining a_record_response_header, the question and
+    a_record_response_answer, without any of the intermediate calls.
+
+    Parameters
+    ----------
+    request : bytearray
+        A record request received
+
+    Returns
+    -------
+    packet : bytes
+        constructed DNS response, None if the request is malformed
+    """
+    # The cache needs hashable slices; this does not copy a request that is already bytes
+    request = bytes(request)
+
+    # Drop requests without a complete header and question, like dns_core does
+    if len(request) <= 12:
+        return None
+
+    question_stop = request.find(0, 12) + 5
+    if question_stop == 4 or question_stop > len(request):
+        return None
+
+    # Only echo the question back for A record internet class requests
+    if request[question_stop - 1] != 1 or request[question_stop - 3] != 1:
+        question_stop = 12
+
+    # Questions longer than a legal qname are built every time to keep the cache bounded
+    template = _cached_template if question_stop - 12 <= _MAX_QUESTION else _build_template
+
+    return request[0:2] + template(request[2:6], request[12:question_stop])
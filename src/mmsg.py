@@ -0,0 +1,232 @@
+""" Send and receive batches of UDP datagrams with the Linux sendmmsg and recvmmsg system calls. """
+
+import ctypes
+import ctypes.util
+import os
+import socket
+from errno import EBADF, EINTR, ENOTSOCK
+from functools import lru_cache
+
+# Source for the structure layouts: https://man7.org/linux/man-pages/man2/sendmmsg.2.html
+#                                   https://man7.org/linux/man-pages/man2/recvmmsg.2.html
+
+
+class iovec(ctypes.Structure):
+    _fields_ = [('iov_base', ctypes.c_void_p),
+                ('iov_len', ctypes.c_size_t)]
+
+
+class sockaddr_in(ctypes.Structure):
+    _fields_ = [('sin_family', ctypes.c_ushort),
+                ('sin_port', ctypes.c_uint16),
+                ('sin_addr', ctypes.c_ubyte * 4),
+                ('sin_zero', ctypes.c_ubyte * 8)]
+
+
+class msghdr(ctypes.Structure):
+    _fields_ = [('msg_name', ctypes.c_void_p),
+                ('msg_namelen', ctypes.c_uint32),
+                ('msg_iov', ctypes.POINTER(iovec)),
+                ('msg_iovlen', ctypes.c_size_t),
+                ('msg_control', ctypes.c_void_p),
+                ('msg_controllen', ctypes.c_size_t),
+                ('msg_flags', ctypes.c_int)]
+
+
+class mmsghdr(ctypes.Structure):
+    _fields_ = [('msg_hdr', msghdr),
+                ('msg_len', ctypes.c_uint)]
+
+
+# Block until one datagram is available, then return whatever else is queued
+MSG_WAITFORONE = 0x10000
+
+# sendmmsg and recvmmsg are Linux only, leave them as None elsewhere so callers can fall back
+_libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+_sendmmsg = getattr(_libc, 'sendmmsg', None)
+_recvmmsg = getattr(_libc, 'recvmmsg', None)
+
+if _sendmmsg is not None:
+    _sendmmsg.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int]
+    _sendmmsg.restype = ctypes.c_int
+
+if _recvmmsg is not None:
+    _recvmmsg.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int,
+                          ctypes.c_void_p]
+    _recvmmsg.restype = ctypes.c_int
+
+HAVE_SENDMMSG = _sendmmsg is not None
+HAVE_RECVMMSG = _recvmmsg is not None
+
+_SOCKADDR_IN_SIZE = ctypes.sizeof(sockaddr_in)
+
+# Errors that affect the whole socket rather than a single destination
+SOCKET_ERRORS = (EBADF, ENOTSOCK)
+
+
+@lru_cache(maxsize=4096)
+def _sockaddr(ip: str, port: int) -> sockaddr_in:
+    """
+    Convert an (ip, port) address to a sockaddr_in, caching recently seen clients.
+
+    The returned structure is shared between calls and must not be modified.
+
+    Parameters
+    ----------
+    ip : str
+        IPv4 address
+    port : int
+        port number
+
+    Returns
+    -------
+    addr : sockaddr_in
+        address in the form the kernel expects
+    """
+    addr = sockaddr_in()
+    addr.sin_family = socket.AF_INET
+    addr.sin_port = socket.htons(port)
+    addr.sin_addr = (ctypes.c_ubyte * 4).from_buffer_copy(socket.inet_aton(ip))
+    return addr
+
+
+def sendmmsg_batch(fd: int, packets: list):
+    """
+    Send a batch of datagrams on a socket with as few sendmmsg calls as possible.
+
+    A datagram the kernel refuses to send, e.g. to port 0, is skipped so the
+    rest of the batch still goes out. Errors affecting the whole socket are raised.
+
+    Parameters
+    ----------
+    fd : int
+        file descriptor of an IPv4 UDP socket
+    packets : list
+        list of (packet, address) tuples, where packet is bytes and address is
+        an (ip, port) tuple
+    """
+    count = len(packets)
+    msgs = (mmsghdr * count)()
+    iovs = (iovec * count)()
+
+    # Keep the cached addresses alive until the batch has been sent
+    addrs = [_sockaddr(*address) for _, address in packets]
+
+    for i, (packet, _) in enumerate(packets):
+        # Point straight at the packet's buffer, the packets list keeps it alive
+        iovs[i].iov_base = ctypes.cast(ctypes.c_char_p(packet), ctypes.c_void_p)
+        iovs[i].iov_len = len(packet)
+
+        msgs[i].msg_hdr.msg_name = ctypes.addressof(addrs[i])
+        msgs[i].msg_hdr.msg_namelen = _SOCKADDR_IN_SIZE
+        msgs[i].msg_hdr.msg_iov = ctypes.pointer(iovs[i])
+        msgs[i].msg_hdr.msg_iovlen = 1
+
+    # sendmmsg may send only part of the batch, keep going until it has all been sent
+    sent = 0
+    while sent < count:
+        result = _sendmmsg(fd, ctypes.addressof(msgs[sent]), count - sent, 0)
+        if result < 0:
+            errno = ctypes.get_errno()
+            if errno == EINTR:
+                continue
+            if errno in SOCKET_ERRORS:
+                raise OSError(errno, os.strerror(errno))
+
+            # Only this client's datagram failed, e.g. it sent from port 0, so skip it
+            result = 1
+        sent += result
+
+
+class Receiver():
+    """
+    Receive batches of datagrams from a socket with a single recvmmsg call.
+
+    The message headers, buffers and addresses are allocated once and reused on every call.
+
+    ...
+    Attributes
+    ----------
+    fd : int
+        file descriptor of an IPv4 UDP socket
+
+    vlen : int
+        maximum number of datagrams received per call
+
+    Methods
+    -------
+    receive()
+        Wait for at least one datagram and return every datagram already queued.
+    """
+
+    def __init__(self, fd: int, vlen: int = 32, size: int = 4096):
+        """
+        Parameters
+        ----------
+        fd : int
+            file descriptor of an IPv4 UDP socket
+        vlen : int
+            maximum number of datagrams received per call
+        size : int
+            size of the buffer for each datagram
+        """
+        self.fd = fd
+        self.vlen = vlen
+
+        self._msgs = (mmsghdr * vlen)()
+        self._iovs = (iovec * vlen)()
+        self._addrs = (sockaddr_in * vlen)()
+        self._bufs = [ctypes.create_string_buffer(size) for _ in range(vlen)]
+
+        for i in range(vlen):
+            self._iovs[i].iov_base = ctypes.addressof(self._bufs[i])
+            self._iovs[i].iov_len = size
+
+            self._msgs[i].msg_hdr.msg_name = ctypes.addressof(self._addrs[i])
+            self._msgs[i].msg_hdr.msg_namelen = _SOCKADDR_IN_SIZE
+            self._msgs[i].msg_hdr.msg_iov = ctypes.pointer(self._iovs[i])
+            self._msgs[i].msg_hdr.msg_iovlen = 1
+
+        # Number of messages filled by the last recvmmsg call
+        self._filled = 0
+
+    def receive(self) -> list:
+        """
+        Wait for at least one datagram and return every datagram already queued.
+
+        Returns
+        -------
+        batch : list
+            list of (data, address) tuples received, where data is bytes and
+            address is an (ip, port) tuple
+        """
+        msgs = self._msgs
+        bufs = self._bufs
+        addrs = self._addrs
+
+        # The kernel overwrote the address lengths of the messages filled by the last call
+        for i in range(self._filled):
+            msgs[i].msg_hdr.msg_namelen = _SOCKADDR_IN_SIZE
+
+        # Retry on interrupted calls like the socket module does for recvfrom
+        while True:
+            count = _recvmmsg(self.fd, ctypes.addressof(msgs), self.vlen, MSG_WAITFORONE, None)
+            if count >= 0:
+                break
+            errno = ctypes.get_errno()
+            if errno != EINTR:
+                raise OSError(errno, os.strerror(errno))
+        self._filled = count
+
+        # Copy out only the received bytes, the buffers are reused by the next call
+        string_at = ctypes.string_at
+        inet_ntoa = socket.inet_ntoa
+        ntohs = socket.ntohs
+
+        batch = []
+        for i in range(count):
+            addr = addrs[i]
+            batch.append((string_at(bufs[i], msgs[i].msg_len),
+                          (inet_ntoa(bytes(addr.sin_addr)), ntohs(addr.sin_port))))
+
+        return batch
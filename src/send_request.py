@@ -3,7 +3,7 @@ from dns_message import Message
 import argparse
 
 
-def main(dns_address: str = '127.0.0.1') -> bytearray:
+def main(dns_address: str = '127.0.0.1') -> bytes:
     """
     Construct an A record request and send it.
 
@@ -14,12 +14,13 @@ def main(dns_address: str = '127.0.0.1') -> bytearray:
 
     Returns
     -------
-    response : bytearray
-        a bytearray of the DNS spoofer response
+    response : bytes
+        bytes of the DNS spoofer response
     """
     # Open a socket and constuct a query
     query = Message(dns_address, 53)
     query.start_socket()
+    query.connect()
     query.send_query('foo.com')
 
     # Listen for a response back.
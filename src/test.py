@@ -1,5 +1,13 @@
+import os
 import pytest
-from dns_message import Message
+import random
+import socket
+import subprocess
+import sys
+import time
+import dns_message
+import mmsg
+from dns_message import Message, build_response
 
 dns = Message("127.0.0.1", 1024)
 dns.start_socket()
@@ -24,6 +32,14 @@ def test_response_header():
     assert dns.a_record_response_header(request, True) == header
 
 
+def test_response_header_z_and_opcode():
+    # Inverse query with recursion desired and all three Z bits set
+    flagged = request[:2] + bytearray([0x09, 0x70]) + request[4:]
+    header = bytearray([0xAA, 0xBB, 0x89, 0xF4, 0x00, 0x01,
+                        0x00, 0x01, 0x00, 0x00, 0x00, 0x00])
+    assert dns.a_record_response_header(flagged, True) == header
+
+
 def test_query_question():
     question = bytearray([0x07, 0x65, 0x78, 0x61, 0x6D, 0x70, 0x6C,
                           0x65, 0x03, 0x63, 0x6F, 0x6D, 0x00, 0x00, 0x01, 0x00, 0x01])
@@ -39,9 +55,241 @@ def test_response_answer():
                           0x00, 0x00, 0x00, 0x00, 0x00, 0x04, 0x06, 0x06, 0x06, 0x06])
     assert dns.a_record_response_answer() == response
 
+
+def test_build_response():
+    response = bytearray([0xAA, 0xBB, 0x81, 0x80, 0x00, 0x01, 0x00, 0x01, 0x00, 0x00, 0x00, 0x00,
+                          0x07, 0x65, 0x78, 0x61, 0x6D, 0x70, 0x6C, 0x65, 0x03, 0x63, 0x6F, 0x6D,
+                          0x00, 0x00, 0x01, 0x00, 0x01, 0xC0, 0x0C, 0x00, 0x01, 0x00, 0x01,
+                          0x00, 0x00, 0x00, 0x00, 0x00, 0x04, 0x06, 0x06, 0x06, 0x06])
+    assert build_response(request) == response
+
+    # The ID is copied over from the request
+    assert build_response(bytearray([0x12, 0x34]) + request[2:]) == \
+        bytearray([0x12, 0x34]) + response[2:]
+
+def test_build_response_long_question():
+    long_request = request[:12] + b"\x3f" + b"a" * 63 + b"\x3f" + b"b" * 63 + b"\x3f" + b"c" * 63 + \
+        b"\x3f" + b"d" * 63 + b"\x3f" + b"e" * 63 + b"\x00\x00\x01\x00\x01"
+    cached = dns_message._cached_template.cache_info().currsize
+
+    # Questions longer than a legal qname are answered but not cached
+    assert build_response(long_request) == \
+        bytes(dns.a_record_response_header(long_request, True)) + long_request[12:] + \
+        dns.a_record_response_answer()
+    assert dns_message._cached_template.cache_info().currsize == cached
+
+
+def test_build_response_malformed():
+    # Too short to hold a question
+    assert build_response(request[:3]) is None
+    assert build_response(request[:12]) is None
+
+    # No null byte terminating the qname
+    assert build_response(request[:24]) is None
+
+    # Question cut short after the qname
+    assert build_response(request[:27]) is None
+
 # ------------- Test a request that the DNS spoofer cannot handle ------------ #
 request_not_impl = bytearray([0xAA, 0xBB, 1, 0, 0, 1, 0, 0, 0, 0, 0, 0, 0x07, 0x65, 0x78, 0x61, 0x6D, 0x70,
                      0x6C, 0x65, 0x03, 0x63, 0x6F, 0x6D, 0x00, 0x00, 0x02, 0x00, 0x01, 0x05, 0x02, 0x03, 0x04])
 
 def test_parse_query_question_not_impl():
-    assert dns.parse_query_question(request_not_impl) == 0 
\ No newline at end of file
+    assert dns.parse_query_question(request_not_impl) == 0
+
+
+def test_build_response_matches_header_path():
+    # Every combination of the two flag bytes, with and without the question echoed back
+    answer = dns.a_record_response_answer()
+    for query in (request, request_not_impl):
+        stop = dns.parse_query_question(query) or 12
+        for byte_3 in range(256):
+            for byte_4 in range(256):
+                flagged = query[:2] + bytearray([byte_3, byte_4]) + query[4:]
+                assert build_response(flagged) == \
+                    bytes(dns.a_record_response_header(flagged, True)) + flagged[12:stop] + answer
+
+# ------------------------ Test batched sending and receiving ------------------------ #
+
+
+def make_clients(count):
+    clients = []
+    for _ in range(count):
+        client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        client.bind(("127.0.0.1", 0))
+        client.settimeout(2)
+        clients.append(client)
+    return clients
+
+
+def make_query(identifier, url):
+    return bytes([identifier >> 8, identifier & 0xFF]) + dns.a_record_query_header()[2:] + \
+        dns.a_record_query_question(url)
+
+
+@pytest.mark.parametrize("batched", [True, False])
+def test_send_responses(monkeypatch, batched):
+    if not batched:
+        monkeypatch.setattr(mmsg, "HAVE_SENDMMSG", False)
+        monkeypatch.setattr(mmsg, "HAVE_RECVMMSG", False)
+
+    clients = make_clients(3)
+    queries = [make_query(0x1001, "foo.com"), make_query(0x2002, "example.com"),
+               make_query(0x3003, "a.b.example.org")]
+
+    for client, query in zip(clients, queries):
+        client.sendto(query, ("127.0.0.1", 1024))
+
+    dns.send_responses(dns.receive_batch())
+
+    for client, query in zip(clients, queries):
+        assert client.recv(4096) == build_response(query)
+        client.close()
+
+
+@pytest.mark.parametrize("batched", [True, False])
+def test_receive_batch(monkeypatch, batched):
+    if not batched:
+        monkeypatch.setattr(mmsg, "HAVE_RECVMMSG", False)
+
+    # Two batches in a row from different clients, the buffers and addresses are reused
+    for count in (3, 2):
+        clients = make_clients(count)
+        queries = [make_query(i, "batch%d.com" % count) for i in range(count)]
+
+        for client, query in zip(clients, queries):
+            client.sendto(query, ("127.0.0.1", 1024))
+
+        assert dns.receive_batch() == \
+            [(query, client.getsockname()) for client, query in zip(clients, queries)]
+
+        for client in clients:
+            client.close()
+
+
+@pytest.mark.parametrize("batched", [True, False])
+def test_receive_batch_timeout(monkeypatch, batched):
+    if not batched:
+        monkeypatch.setattr(mmsg, "HAVE_RECVMMSG", False)
+
+    # The socket's timeout is waited out before raising, rather than returning at once
+    dns.socket.settimeout(0.2)
+    try:
+        start = time.monotonic()
+        with pytest.raises(socket.timeout):
+            dns.receive_batch()
+        assert time.monotonic() - start >= 0.15
+    finally:
+        dns.socket.settimeout(None)
+
+
+@pytest.mark.parametrize("batched", [True, False])
+def test_receive_batch_error(monkeypatch, batched):
+    if not batched:
+        monkeypatch.setattr(mmsg, "HAVE_RECVMMSG", False)
+
+    # Errors other than a timeout exit like the send paths do
+    closed = Message("127.0.0.1", 0)
+    closed.start_socket()
+    closed.socket.close()
+    with pytest.raises(SystemExit):
+        closed.receive_batch()
+
+
+@pytest.mark.parametrize("connect", [True, False])
+def test_send_query(connect):
+    client = Message("127.0.0.1", 1024)
+    client.start_socket()
+
+    # send_query connects the socket itself when connect() has not been called
+    if connect:
+        client.connect()
+    client.send_query("example.com")
+
+    assert dns.receive() == (make_query(0xAABB, "example.com"), client.socket.getsockname())
+    client.socket.close()
+
+
+@pytest.mark.skipif(not hasattr(socket, "SO_REUSEPORT"), reason="SO_REUSEPORT is not available")
+def test_bind_reuse_port():
+    first = Message("127.0.0.1", 1025)
+    second = Message("127.0.0.1", 1025)
+    first.start_socket()
+    second.start_socket()
+
+    # Workers sharing the port both bind to it
+    first.bind(reuse_port=True)
+    second.bind(reuse_port=True)
+    second.socket.close()
+
+    # Without the option a second bind still fails, so two daemons cannot start by accident
+    second.start_socket()
+    with pytest.raises(SystemExit):
+        second.bind()
+
+    first.socket.close()
+    second.socket.close()
+
+
+@pytest.mark.skipif(not mmsg.HAVE_SENDMMSG, reason="sendmmsg is not available")
+def test_sendmmsg_batch_skips_failed_client():
+    clients = make_clients(2)
+    sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    # Sending to port 0 fails with EINVAL, the datagrams around it are still sent
+    mmsg.sendmmsg_batch(sender.fileno(), [(b"first", clients[0].getsockname()),
+                                          (b"invalid", ("127.0.0.1", 0)),
+                                          (b"second", clients[1].getsockname())])
+
+    assert clients[0].recv(4096) == b"first"
+    assert clients[1].recv(4096) == b"second"
+
+    sender.close()
+    for client in clients:
+        client.close()
+
+
+# ---------------------------- Test the C responder core ---------------------------- #
+try:
+    import dns_core
+except ImportError:
+    dns_core = None
+
+SERVE_CORE = """
+import socket, sys, dns_core
+core = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+core.bind(("127.0.0.1", 0))
+print(core.getsockname()[1], flush=True)
+dns_core.serve_forever(core.fileno(), int.from_bytes(socket.inet_aton("6.6.6.6"), "big"))
+"""
+
+
+@pytest.mark.skipif(dns_core is None, reason="dns_core has not been built")
+def test_dns_core_matches_build_response():
+    core = subprocess.Popen([sys.executable, "-c", SERVE_CORE], stdout=subprocess.PIPE,
+                            cwd=os.path.dirname(os.path.abspath(__file__)))
+    try:
+        port = int(core.stdout.readline())
+        client = make_clients(1)[0]
+        client.connect(("127.0.0.1", port))
+
+        rng = random.Random(1)
+        qtypes = [b"\x00\x01\x00\x01", b"\x00\x1c\x00\x01", b"\x00\x01\x00\x03"]
+        for _ in range(200):
+            query = bytes([rng.randrange(256) for _ in range(4)]) + request[4:12] + \
+                request[12:25] + rng.choice(qtypes) + rng.choice([b"", request[29:]])
+            client.send(query)
+            assert client.recv(4096) == build_response(query)
+
+        # Malformed requests get no reply, the next reply is for the valid request after them
+        for malformed in [request[:3], request[:12], request[:24], request[:27]]:
+            assert build_response(malformed) is None
+            client.send(malformed)
+            client.send(request)
+            assert client.recv(4096) == build_response(request)
+
+        client.close()
+    finally:
+        core.kill()
+        core.wait()
+        core.stdout.close()